@@ -1,13 +1,17 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+import orjson
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
-import pdfplumber
-from docx import Document
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
-from docx.shared import Pt
+from urllib.parse import urldefrag, urlparse
+# fitz (PyMuPDF) and docx are imported inside the functions that use them
+# so the first page render doesn't wait on them
 
 # Page config
 st.set_page_config(
@@ -29,6 +33,45 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ================================================================
+# HTTP SESSION
+# ================================================================
+
+@st.cache_resource(show_spinner=False)
+def get_session():
+    """
+    Return the pooled session shared by all fetchers.
+    Cached as a resource so keep-alive connections to the auditor.on.ca /
+    news.ontario.ca hosts survive Streamlit reruns.
+    """
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'Mozilla/5.0'})
+    retries = Retry(
+        total=2,
+        connect=2,
+        read=1,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods={'GET', 'HEAD'},
+        # A throttled host's Retry-After can be minutes; use our own backoff instead
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# (connect, read) seconds; a slow host fails fast instead of stalling its worker
+REQUEST_TIMEOUT = (3, 15)
+
+# Fetched citations are cached by URL so reruns don't hit the network again.
+# Cached functions raise on failure, since st.cache_data doesn't cache
+# exceptions; a failed URL is retried on the next run.
+CACHE_TTL = 3600
+
+class CitationError(Exception):
+    """A URL was fetched but no citation could be built from it."""
+
 # ================================================================
 # URL DETECTION FUNCTION
 # ================================================================
@@ -49,11 +92,22 @@ def detect_citation_type(url):
 # AG ANNUAL REPORT FUNCTIONS
 # ================================================================
 
+_RE_URL_YEAR = re.compile(r'(?:en|ar|fr)(\d{2,4})')
+_RE_4DIGIT_YEAR = re.compile(r'19\d{2}|20\d{2}')
+_RE_CHAP_V = re.compile(r'v\d+_(\d)(\d{2})')
+_RE_CHAP_EN = re.compile(r'^(\d)(\d{2})en\d{2}')
+_RE_PROV_AUDITOR = re.compile(r'^\d{4}\s+(?:Provincial\s+)?Auditor\'?s?\s+Report:\s*', re.I)
+_RE_VFM_PREFIX = re.compile(r'^VFM\s+\d+\.\d{2}\s*:\s*', re.I)
+_RE_SECTION_COLON_PREFIX = re.compile(r'^\d+\.\d{2}\s*:\s*')
+_RE_SECTION_PREFIX = re.compile(r'^\d+\.\d{2}\s+')
+_RE_CONTENT_CLASS = re.compile('content|main|article', re.I)
+
 def is_pdf_url(url):
-    return url.lower().endswith('.pdf')
+    # Lowercase only the suffix rather than copying the whole URL
+    return url[-4:].lower() == '.pdf'
 
 def extract_year_from_url(url):
-    match = re.search(r'(?:en|ar|fr)(\d{2,4})', url)
+    match = _RE_URL_YEAR.search(url)
     if match:
         year = match.group(1)
         if len(year) == 2:
@@ -63,13 +117,13 @@ def extract_year_from_url(url):
             else:
                 year = '20' + year
         return year
-    match = re.search(r'19\d{2}|20\d{2}', url)
+    match = _RE_4DIGIT_YEAR.search(url)
     if match:
         return match.group(0)
     return None
 
 def extract_chapter_section_from_filename(filename):
-    match = re.search(r'v\d+_(\d)(\d{2})', filename)
+    match = _RE_CHAP_V.search(filename)
     if match:
         chapter = match.group(1)
         section_digits = match.group(2)
@@ -77,7 +131,7 @@ def extract_chapter_section_from_filename(filename):
             return chapter, f"{chapter}.{section_digits}"
         else:
             return chapter, None
-    match = re.search(r'^(\d)(\d{2})en\d{2}', filename)
+    match = _RE_CHAP_EN.search(filename)
     if match:
         chapter = match.group(1)
         section_digits = match.group(2)
@@ -87,62 +141,81 @@ def extract_chapter_section_from_filename(filename):
             return chapter, None
     return None, None
 
-def extract_title_from_pdf_metadata(url):
+# The /Info dictionary usually sits near the trailer, so try the tail first
+PDF_TAIL_BYTES = 65536
+
+def read_pdf_title(content):
+    """Return the raw Title metadata from PDF bytes, or None if it can't be read."""
+    import fitz
     try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        pdf_file = BytesIO(response.content)
-        with pdfplumber.open(pdf_file) as pdf:
-            metadata = pdf.metadata
-            if metadata and 'Title' in metadata and metadata['Title']:
-                title = metadata['Title']
-                if isinstance(title, bytes):
-                    title = title.decode('utf-8', errors='ignore')
-                title = title.strip()
-                title = re.sub(r'^\d{4}\s+(?:Provincial\s+)?Auditor\'?s?\s+Report:\s*', '', title, flags=re.I)
-                title = re.sub(r'^VFM\s+\d+\.\d{2}\s*:\s*', '', title, flags=re.I)
-                title = re.sub(r'^\d+\.\d{2}\s*:\s*', '', title)
-                title = re.sub(r'^\d+\.\d{2}\s+', '', title)
-                return title if title else None
+        with fitz.open(stream=content, filetype='pdf') as doc:
+            title = (doc.metadata or {}).get('title')
+    except Exception:
         return None
-    except:
+    if not title:
         return None
+    return title.strip() or None
 
-def extract_title_from_html(url):
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=10)
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def extract_title_from_pdf_metadata(url):
+    response = get_session().get(url, headers={'Range': f'bytes=-{PDF_TAIL_BYTES}'}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    title = read_pdf_title(response.content)
+    if not title and response.status_code == 206:
+        # Metadata wasn't in the tail; fall back to the whole file
+        response = get_session().get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-        for tag in ['h1', 'h2', 'h3']:
-            heading = soup.find(tag)
-            if heading and heading.text.strip():
-                title = heading.text.strip()
-                if "Office of the Auditor General" not in title and "Auditor General" not in title:
-                    return title
-        content_area = soup.find(['div', 'section'], class_=re.compile('content|main|article', re.I))
-        if content_area:
-            heading = content_area.find(['h1', 'h2', 'h3'])
-            if heading and heading.text.strip():
-                title = heading.text.strip()
-                if "Office of the Auditor General" not in title:
-                    return title
-        return None
-    except:
-        return None
+        title = read_pdf_title(response.content)
+    if title:
+        title = _RE_PROV_AUDITOR.sub('', title)
+        title = _RE_VFM_PREFIX.sub('', title)
+        title = _RE_SECTION_COLON_PREFIX.sub('', title)
+        title = _RE_SECTION_PREFIX.sub('', title)
+    if not title:
+        raise CitationError("Could not extract title from PDF")
+    return title
+
+def read_html_title(content):
+    """Return the report title from AG page HTML, or None if none is found."""
+    # Most pages resolve from their headings alone, so parse only those first
+    headings = BeautifulSoup(content, 'lxml', parse_only=SoupStrainer(['h1', 'h2', 'h3']))
+    for tag in ['h1', 'h2', 'h3']:
+        heading = headings.find(tag)
+        if heading and heading.text.strip():
+            title = heading.text.strip()
+            if "Office of the Auditor General" not in title and "Auditor General" not in title:
+                return title
+    soup = BeautifulSoup(content, 'lxml')
+    content_area = soup.find(['div', 'section'], class_=_RE_CONTENT_CLASS)
+    if content_area:
+        heading = content_area.find(['h1', 'h2', 'h3'])
+        if heading and heading.text.strip():
+            title = heading.text.strip()
+            if "Office of the Auditor General" not in title:
+                return title
+    return None
 
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def extract_title_from_html(url):
+    response = get_session().get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    title = read_html_title(response.content)
+    if not title:
+        raise CitationError("Could not extract title from page")
+    return title
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
 def fetch_ag_citation(url):
     year = extract_year_from_url(url)
     if not year:
-        return None, "Could not extract year"
+        raise CitationError("Could not extract year")
     org_name = "Office of the Auditor General of Ontario"
     year_report = f"{year} Annual Report"
-    if is_pdf_url(url):
-        title = extract_title_from_pdf_metadata(url)
-        if not title:
-            return None, "Could not extract title from PDF"
-        filename = url.split('/')[-1]
+    # Fragments never reach the server, so URLs differing only by #anchor share one fetch
+    page_url = urldefrag(url).url
+    if is_pdf_url(page_url):
+        title = extract_title_from_pdf_metadata(page_url)
+        filename = page_url.split('/')[-1]
         chapter, section = extract_chapter_section_from_filename(filename)
         title = ' '.join(title.split())
         if chapter and section:
@@ -152,53 +225,61 @@ def fetch_ag_citation(url):
         else:
             citation = f'{org_name}, "[{title}]({url})", *{year_report}*.'
     else:
-        title = extract_title_from_html(url)
-        if not title:
-            return None, "Could not extract title from page"
+        title = extract_title_from_html(page_url)
         title = ' '.join(title.split())
         citation = f'{org_name}, "[{title}]({url})", *{year_report}*.'
-    return citation, None
+    return citation
 
 # ================================================================
 # ONTARIO NEWS RELEASE FUNCTIONS
 # ================================================================
 
+NEWS_API_HOST = "api.news.ontario.ca"
+# First all-digit path segment, e.g. /en/release/1006488/slug
+_RE_RELEASE_ID = re.compile(r'/(\d+)(?=/|$)')
+
 def extract_release_id(url):
     """Extract the numeric release ID from an Ontario news release URL."""
-    parts = url.split('/')
-    for part in parts:
-        if part.isdigit():
-            return part
-    return None
+    match = _RE_RELEASE_ID.search(url)
+    return match.group(1) if match else None
 
 def format_ministries(main_ministry, partner_ministries):
     """Format multiple ministries with proper comma placement and final 'and'."""
-    ministries = [main_ministry] + [m['name'] for m in partner_ministries if 'name' in m and m['name'] != main_ministry]
-    ministries = list(dict.fromkeys(ministries))
+    seen = set()
+    ministries = []
+    for name in (main_ministry, *(m.get('name') for m in partner_ministries)):
+        if name and name not in seen:
+            seen.add(name)
+            ministries.append(name)
     
-    if len(ministries) == 1:
+    if not ministries:
+        return ''
+    elif len(ministries) == 1:
         return ministries[0]
     elif len(ministries) == 2:
         return f"{ministries[0]} and {ministries[1]}"
     else:
         return ", ".join(ministries[:-1]) + f", and {ministries[-1]}"
 
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def fetch_release_content(release_id):
+    """Fetch the raw API response for a release, cached by ID rather than by URL."""
+    api_url = f"https://{NEWS_API_HOST}/api/v1/releases/{release_id}?language=en"
+    response = get_session().get(api_url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
 def fetch_news_release_citation(url):
     """Fetch data from Ontario API and generate formatted citation."""
     release_id = extract_release_id(url)
     if not release_id:
-        return None, f"Could not extract release ID from URL"
-    
-    api_url = f"https://api.news.ontario.ca/api/v1/releases/{release_id}?language=en"
+        raise CitationError("Could not extract release ID from URL")
     
-    try:
-        response = requests.get(api_url, timeout=10)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        return None, f"Error fetching data: {e}"
+    content = fetch_release_content(release_id)
     
     try:
-        data = response.json()['data']
+        data = orjson.loads(content)['data']
         
         main_ministry = data.get('ministry_name', '')
         partner_ministries = data.get('partner_ministries', [])
@@ -210,15 +291,67 @@ def fetch_news_release_citation(url):
         
         citation = f'{ministries_str}, "[{title}]({url})", *{release_type}*, {date_str}.'
         
-        return citation, None
+        return citation
     except Exception as e:
-        return None, f"Error parsing data: {e}"
+        raise CitationError(f"Error parsing data: {e}") from e
+
+# ================================================================
+# CITATION DISPATCH
+# ================================================================
+
+# Number of URLs fetched concurrently; the work is network-bound
+MAX_WORKERS = 8
+
+def fetch_citation(url):
+    """
+    Detect the citation type of a URL and fetch its citation.
+    Returns (citation, None) on success or (None, error message) on failure.
+    """
+    citation_type = detect_citation_type(url)
+    try:
+        if citation_type == 'ag':
+            return fetch_ag_citation(url), None
+        elif citation_type == 'news':
+            return fetch_news_release_citation(url), None
+        else:
+            return None, "URL is not a recognized AG Annual Report or Ontario News Release"
+    except requests.RequestException as e:
+        return None, f"Error fetching data: {e}"
+    except CitationError as e:
+        return None, str(e)
+
+def citation_hosts(urls):
+    """Return the set of hosts that fetching the given URLs will connect to."""
+    hosts = set()
+    for url in urls:
+        citation_type = detect_citation_type(url)
+        if citation_type == 'ag':
+            hosts.add(urlparse(url).netloc)
+        elif citation_type == 'news':
+            hosts.add(NEWS_API_HOST)
+    hosts.discard('')
+    return hosts
+
+def warm_connections(urls):
+    """Open pooled connections to each host in the background, without waiting."""
+    session = get_session()
+    executor = ThreadPoolExecutor(max_workers=4)
+    for host in citation_hosts(urls):
+        executor.submit(session.head, f"https://{host}/", timeout=2)
+    executor.shutdown(wait=False)
 
 # ================================================================
 # SHARED DOCX FUNCTIONS
 # ================================================================
 
+# Negated character classes instead of lazy '.*?' runs; link text may still
+# contain ']' as long as it isn't the '](' that starts the URL
+_RE_MD_TOKENS = re.compile(r'(\[[^\]]*(?:\](?!\()[^\]]*)*\]\([^)]*\)|\*[^*]*\*|_[^_]*_)')
+_RE_MD_LINK = re.compile(r'\[([^\]]*(?:\](?!\()[^\]]*)*)\]\(([^)]*)\)')
+
 def add_hyperlink(paragraph, text, url):
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
     part = paragraph.part
     r_id = part.relate_to(url, reltype="http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink", is_external=True)
     hyperlink = OxmlElement('w:hyperlink')
@@ -243,19 +376,20 @@ def add_hyperlink(paragraph, text, url):
     paragraph._p.append(hyperlink)
     return hyperlink
 
+@st.cache_data(ttl=CACHE_TTL, max_entries=32, show_spinner=False)
 def generate_docx(citation_texts):
+    from docx import Document
+    from docx.shared import Pt
     doc = Document()
     for citation_md in citation_texts:
         p = doc.add_paragraph()
-        pattern = re.compile(r'(\[.*?\]\(.*?\)|\*.*?\*|_.*?_)')
-        parts = pattern.split(citation_md)
+        parts = _RE_MD_TOKENS.split(citation_md)
         for part in parts:
             if not part:
                 continue
             if part.startswith('[') and '](' in part and part.endswith(')'):
-                link_text = re.findall(r'\[(.*?)\]', part)[0]
-                link_url = re.findall(r'\((.*?)\)', part)[0]
-                add_hyperlink(p, link_text, link_url)
+                link = _RE_MD_LINK.match(part)
+                add_hyperlink(p, link.group(1), link.group(2))
             elif (part.startswith('*') and part.endswith('*')) or (part.startswith('_') and part.endswith('_')):
                 run = p.add_run(part[1:-1])
                 run.italic = True
@@ -268,8 +402,7 @@ def generate_docx(citation_texts):
         p.add_run('\n')
     buffer = BytesIO()
     doc.save(buffer)
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
 
 # ================================================================
 # STREAMLIT UI
@@ -320,44 +453,48 @@ if generate_btn:
         st.warning("⚠️ Please enter at least one URL")
     else:
         urls = [url.strip() for url in urls_input.split('\n') if url.strip()]
+        warm_connections(urls)
         st.markdown("---")
         st.markdown("### 📝 Results")
-        citations = []
+        citations = [None] * len(urls)
         progress_bar = st.progress(0)
         status_container = st.container()
 
-        for i, url in enumerate(urls):
-            progress = (i + 1) / len(urls)
-            progress_bar.progress(progress)
-            
-            with status_container:
-                with st.spinner(f"Processing [{i+1}/{len(urls)}]: {url[:60]}..."):
-                    # Auto-detect citation type
-                    citation_type = detect_citation_type(url)
-                    
-                    if citation_type == 'ag':
-                        citation, error = fetch_ag_citation(url)
-                    elif citation_type == 'news':
-                        citation, error = fetch_news_release_citation(url)
-                    else:
-                        error = "URL is not a recognized AG Annual Report or Ontario News Release"
-                        citation = None
-                    
-                    if error:
-                        st.error(f"❌ {url}\n{error}")
-                    else:
-                        citations.append((url, citation))
-                        st.success(f"✓ {url[:70]}...")
+        # Workers call st.cache_data functions, which expect the script's run context
+        ctx = get_script_run_ctx()
+        with st.spinner(f"Processing {len(urls)} URL(s)..."):
+            with ThreadPoolExecutor(
+                max_workers=MAX_WORKERS,
+                initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+            ) as executor:
+                futures = {executor.submit(fetch_citation, url): i for i, url in enumerate(urls)}
+                for done, future in enumerate(as_completed(futures), start=1):
+                    i = futures[future]
+                    url = urls[i]
+                    progress_bar.progress(done / len(urls))
+                    try:
+                        citation, error = future.result()
+                    except Exception as e:
+                        citation, error = None, f"Unexpected error: {e}"
+
+                    with status_container:
+                        if error:
+                            st.error(f"❌ {url}\n{error}")
+                        else:
+                            citations[i] = (url, citation)
+                            st.success(f"✓ {url[:70]}...")
 
         progress_bar.empty()
+        # Keep the input order regardless of completion order
+        citations = [c for c in citations if c]
 
         if citations:
-            all_citation_texts = [c for _, c in citations]
+            all_citation_texts = tuple(c for _, c in citations)
             
-            docx_buffer = generate_docx(all_citation_texts)
+            docx_bytes = generate_docx(all_citation_texts)
             st.download_button(
                 label="📥 Download All Citations (Word DOCX)",
-                data=docx_buffer,
+                data=docx_bytes,
                 file_name="Citations.docx",
                 mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
             )